@@ -1,6 +1,21 @@
 import streamlit as st
 import google.generativeai as genai
+import fitz  # pymupdf
+from google.generativeai import caching
+from google.api_core.exceptions import NotFound, PermissionDenied, ResourceExhausted, ServiceUnavailable
+import asyncio
+import datetime
+from functools import lru_cache
+import gc
 import os
+import re
+import hashlib
+import json
+import shelve
+import shutil
+import tempfile
+import threading
+import time
 
 # --- CONFIGURATION ---
 GEMINI_API_KEY = os.getenv("GOOGLE_API_KEY") 
@@ -8,54 +23,555 @@ if not GEMINI_API_KEY:
     st.error("Please set your GEMINI_API_KEY environment variable or Streamlit secret.")
     st.stop()
 
-genai.configure(api_key=GEMINI_API_KEY)
 MODEL_NAME = "gemini-3.5-flash"  
+LLM_CACHE_PATH = ".llm_cache"
+# Cached answers include patient histories and report analyses, so they expire.
+LLM_CACHE_TTL = datetime.timedelta(hours=24)
+LLM_CACHE_SWEEP_INTERVAL = datetime.timedelta(hours=1)
+
+# Gemini context caching is opt-in: cached contents have a minimum token size
+# and are billed for storage, so only enable it for long chat sessions.
+CONTEXT_CACHE_ENABLED = os.getenv("GEMINI_CONTEXT_CACHE", "").lower() in ("1", "true", "yes")
+CONTEXT_CACHE_TTL = datetime.timedelta(minutes=30)
+CONTEXT_CACHE_REFRESH_MESSAGES = 8
+CONTEXT_CACHE_EXPIRY_MARGIN = datetime.timedelta(minutes=1)
+
+# Only the most recent turns are sent verbatim; older ones are folded into a
+# running summary a whole window at a time.
+HISTORY_WINDOW_TURNS = 8
+HISTORY_SUMMARY_PROMPT = (
+    "Summarize the following conversation between a user and a medical assistant in a few "
+    "sentences. Keep every medical detail the user shared and the key points of the answers."
+)
+
+# Gemini starts returning 429s with only a few requests in flight, so at most
+# this many calls (streamed answers included, until fully read or closed) run
+# at once and throttled calls back off exponentially.
+GEMINI_MAX_CONCURRENCY = 2
+GEMINI_MAX_RETRIES = 5
+
+# 100 DPI keeps printed reports legible at a quarter of the pixels of 200 DPI.
+PDF_RENDER_DPI = 100
+# Each page is its own request and its analysis feeds the merge prompt.
+REPORT_MAX_PAGES = 20
+REPORT_MERGE_PROMPT = (
+    "Below are analyses of the individual pages of one uploaded document. Combine them into a "
+    "single summary of the key medical findings, tests, and any notable results. If none of the "
+    "pages is a medical report, respond: 'Sorry, I can only analyze medical reports.'"
+)
+
+@st.cache_resource
+def _configure_genai(api_key):
+    genai.configure(api_key=api_key)
+
+_configure_genai(GEMINI_API_KEY)
 
 # --- UTILITY FUNCTIONS ---
 
+@st.cache_resource
+def _get_model(model_name, system_instruction=None):
+    return genai.GenerativeModel(model_name=model_name, system_instruction=system_instruction)
+
+MEDICAL_KEYWORDS = frozenset([
+    "symptom", "disease", "treatment", "medicine", "diagnosis", "doctor",
+    "health", "illness", "pain", "fever", "infection", "injury", "test", "scan",
+    "medical", "surgery", "prescription", "allergy", "hospital", "clinic",
+    "blood", "pressure", "diabetes", "cancer", "asthma", "heart", "lungs", "mental health"
+])
+
+# Unanchored, like the original substring check: keywords also match inside
+# words ("symptoms", "asymptomatic", "prediabetes", "unhealthy").
+_MEDICAL_RE = re.compile(
+    "|".join(map(re.escape, sorted(MEDICAL_KEYWORDS, key=len, reverse=True)))
+)
+
+@lru_cache(maxsize=1024)
 def is_medical_query(query):
-    medical_keywords = [
-        "symptom", "disease", "treatment", "medicine", "diagnosis", "doctor",
-        "health", "illness", "pain", "fever", "infection", "injury", "test", "scan",
-        "medical", "surgery", "prescription", "allergy", "hospital", "clinic",
-        "blood", "pressure", "diabetes", "cancer", "asthma", "heart", "lungs", "mental health"
+    return _MEDICAL_RE.search(query.lower()) is not None
+
+# The SDK's async gRPC client is bound to the event loop that first used it, so
+# every Gemini coroutine runs on one long-lived loop instead of asyncio.run().
+@st.cache_resource
+def _event_loop():
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+def _run_async(coro):
+    return asyncio.run_coroutine_threadsafe(coro, _event_loop()).result()
+
+async def _agather(coros):
+    # Unlike asyncio.gather, a TaskGroup cancels the remaining requests as soon
+    # as one fails, so they stop spending quota and throttle permits.
+    try:
+        async with asyncio.TaskGroup() as group:
+            tasks = [group.create_task(coro) for coro in coros]
+    except ExceptionGroup as errors:
+        raise errors.exceptions[0]
+    return [task.result() for task in tasks]
+
+async def _new_semaphore():
+    return asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+
+@st.cache_resource
+def _gemini_semaphore():
+    # Built on the Gemini loop so it is bound there and shared by all sessions.
+    return _run_async(_new_semaphore())
+
+_GEMINI_SEMAPHORE = _gemini_semaphore()
+
+async def _throttled(request, hold=False):
+    # With hold=True the permit stays taken after the call returns; streamed
+    # responses keep it until their _TextStream is closed.
+    await _GEMINI_SEMAPHORE.acquire()
+    try:
+        for attempt in range(GEMINI_MAX_RETRIES):
+            try:
+                result = await request()
+                break
+            except (ResourceExhausted, ServiceUnavailable):
+                if attempt == GEMINI_MAX_RETRIES - 1:
+                    raise
+                await asyncio.sleep(2 ** attempt)
+    except BaseException:
+        _GEMINI_SEMAPHORE.release()
+        raise
+    if not hold:
+        _GEMINI_SEMAPHORE.release()
+    return result
+
+async def _agenerate(model_instance, parts, stream=False):
+    response = await _throttled(lambda: model_instance.generate_content_async(parts, stream=stream), hold=stream)
+    return response if stream else response.text
+
+async def _asend(chat, user_msg, stream=False):
+    response = await _throttled(lambda: chat.send_message_async(user_msg, stream=stream), hold=stream)
+    return response if stream else response.text
+
+_STREAM_END = object()
+
+async def _anext(chunks):
+    try:
+        return await chunks.__anext__()
+    except StopAsyncIteration:
+        return _STREAM_END
+
+async def _aclose(chunks):
+    try:
+        await chunks.aclose()
+    finally:
+        _GEMINI_SEMAPHORE.release()
+
+def _on_event_loop_thread():
+    # The garbage collector can finalize an abandoned stream on any thread,
+    # including the Gemini loop's own, where waiting on that loop deadlocks.
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+def _close_stream(stream):
+    close = getattr(stream, "close", None)
+    if close:
+        close()
+
+class _TextStream:
+    # Pulls chunks off the background loop one at a time so st.write_stream can
+    # render them on the script thread as they arrive. Closing it, or dropping
+    # it unread, closes the gRPC stream and returns the throttle permit taken
+    # by the streamed call.
+
+    _closed = True
+
+    def __init__(self, response):
+        self._loop = _event_loop()
+        self._chunks = response.__aiter__()
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            while not self._closed:
+                chunk = _run_async(_anext(self._chunks))
+                if chunk is _STREAM_END:
+                    break
+                if chunk.parts:
+                    return chunk.text
+        except BaseException:
+            self.close()
+            raise
+        self.close()
+        raise StopIteration
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        # On the loop thread the close can only be scheduled, not waited for.
+        if _on_event_loop_thread():
+            self._loop.create_task(_aclose(self._chunks))
+        else:
+            asyncio.run_coroutine_threadsafe(_aclose(self._chunks), self._loop).result()
+
+    __del__ = close
+
+def _render_pdf_pages(file_path):
+    pages = []
+    with fitz.open(file_path) as doc:
+        if doc.page_count > REPORT_MAX_PAGES:
+            raise ValueError(
+                f"This report has {doc.page_count} pages; at most {REPORT_MAX_PAGES} pages "
+                "can be analyzed at once. Please upload the relevant pages only."
+            )
+        for page in doc:
+            pix = page.get_pixmap(dpi=PDF_RENDER_DPI)
+            pages.append(pix.tobytes("jpeg"))
+            # Only the compressed JPEG is kept per page; the raw raster is
+            # released before the next page is rendered.
+            del pix
+    gc.collect()
+    return pages
+
+def _analyze_pdf_pages(model_instance, prompt, file_path, stream=False):
+    # Every page goes out as its own request in one concurrent batch, then a
+    # final call stitches the per-page analyses together.
+    pages = _render_pdf_pages(file_path)
+    page_requests = [
+        _agenerate(model_instance, [
+            {"text": f"{prompt}\n\n(Page {number} of {len(pages)}.)"},
+            {"mime_type": "image/jpeg", "data": jpeg},
+        ])
+        for number, jpeg in enumerate(pages, start=1)
+    ]
+    page_results = _run_async(_agather(page_requests))
+    if len(page_results) == 1:
+        return iter(page_results) if stream else page_results[0]
+
+    merged = "\n\n".join(f"Page {number}:\n{text}" for number, text in enumerate(page_results, start=1))
+    response = _run_async(_agenerate(model_instance, [f"{REPORT_MERGE_PROMPT}\n\n{merged}"], stream=stream))
+    return _TextStream(response) if stream else response
+
+def _format_history(messages):
+    return [
+        {"role": "user" if msg["role"] == "user" else "model", "parts": [msg["content"]]}
+        for msg in messages
     ]
-    query_lower = query.lower()
-    return any(word in query_lower for word in medical_keywords)
 
-def get_gemini_response(messages, model=MODEL_NAME, vision=False, file_data=None, file_type=None, system_instruction=None):
+def _drop_context_cache(state_key):
+    entry = st.session_state.pop(state_key, None)
+    if entry and "name" in entry:
+        try:
+            caching.CachedContent.get(entry["name"]).delete()
+        except Exception:
+            pass
+
+def _get_context_cache(state_key, messages, model, system_instruction):
+    # Caches the system prompt plus every turn before the latest one, and only
+    # re-creates the cache once the uncached tail has grown past the threshold
+    # or the cache is about to expire. Returns None when nothing is cached.
+    prefix = messages[:-1]
+    entry = st.session_state.get(state_key)
+    if entry and "failed_at" in entry:
+        # Creation failed, usually because the prefix is below Gemini's minimum
+        # cacheable size; don't pay for another attempt until it has grown.
+        if len(prefix) - entry["failed_at"] < CONTEXT_CACHE_REFRESH_MESSAGES:
+            return None
+    elif (
+        entry
+        and entry["system_instruction"] == system_instruction
+        and entry["head"] == prefix[:1]
+        and 0 <= len(prefix) - entry["n_cached"] < CONTEXT_CACHE_REFRESH_MESSAGES
+        and entry["expire_time"] - datetime.datetime.now(datetime.timezone.utc) > CONTEXT_CACHE_EXPIRY_MARGIN
+    ):
+        return entry
+
+    _drop_context_cache(state_key)
+    try:
+        cached = caching.CachedContent.create(
+            model=model,
+            system_instruction=system_instruction,
+            contents=_format_history(prefix),
+            ttl=CONTEXT_CACHE_TTL,
+        )
+    except Exception:
+        st.session_state[state_key] = {"failed_at": len(prefix)}
+        return None
+
+    entry = {
+        "name": cached.name,
+        "model": genai.GenerativeModel.from_cached_content(cached_content=cached),
+        "n_cached": len(prefix),
+        "system_instruction": system_instruction,
+        "head": prefix[:1],
+        "expire_time": cached.expire_time,
+    }
+    st.session_state[state_key] = entry
+    return entry
+
+def windowed_history(state_key, messages, window_turns=HISTORY_WINDOW_TURNS):
+    # Returns the recent messages to send, led by a user/model exchange holding
+    # a summary of everything older. The summary goes in the history rather
+    # than the system instruction so the cached model per instruction stays
+    # shared. The cutoff only moves once a full extra window has built up, so
+    # the sent prefix stays stable in between and the live ChatSession and
+    # context cache remain reusable.
+    summary = st.session_state.get(state_key, {"text": "", "n_summarized": 0})
+    if len(messages) - summary["n_summarized"] > 4 * window_turns:
+        cutoff = len(messages) - 2 * window_turns - 1
+        while cutoff > summary["n_summarized"] and messages[cutoff]["role"] != "user":
+            cutoff -= 1
+        transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages[summary["n_summarized"]:cutoff])
+        prompt = HISTORY_SUMMARY_PROMPT
+        if summary["text"]:
+            prompt += f"\n\nSummary so far:\n{summary['text']}"
+        prompt += f"\n\nConversation:\n{transcript}"
+        summary = {
+            "text": get_gemini_response([{"role": "user", "content": prompt}]),
+            "n_summarized": cutoff,
+        }
+        st.session_state[state_key] = summary
+
+    recent = messages[summary["n_summarized"]:]
+    if not summary["text"]:
+        return recent
+    return [
+        {"role": "user", "content": f"Summary of our earlier conversation:\n{summary['text']}"},
+        {"role": "model", "content": "Understood, I will keep that context in mind."},
+    ] + recent
+
+def _delete_upload(uploaded):
+    # Uploaded reports are medical images; don't leave them in File storage.
+    try:
+        genai.delete_file(uploaded.name)
+    except Exception:
+        pass
+
+def _delete_upload_after(chunks, uploaded):
+    loop = _event_loop()
+    try:
+        yield from chunks
+    finally:
+        if _on_event_loop_thread():
+            loop.run_in_executor(None, _delete_upload, uploaded)
+        else:
+            _delete_upload(uploaded)
+
+def _get_chat(chat_key, model_instance, history):
+    # Reuse the live ChatSession while it is in step with the transcript; a
+    # response-cache hit or a context-cache refresh forces a rebuild. So does a
+    # session whose last streamed answer was abandoned or blocked, because
+    # reading its history raises.
+    chat = st.session_state.get(chat_key) if chat_key else None
+    try:
+        in_step = chat is not None and chat.model is model_instance and len(chat.history) == len(history)
+    except Exception:
+        in_step = False
+    if not in_step:
+        chat = model_instance.start_chat(history=_format_history(history))
+        if chat_key:
+            st.session_state[chat_key] = chat
+    return chat
+
+def get_gemini_response(messages, model=MODEL_NAME, vision=False, file_path=None, file_type=None, system_instruction=None, context_cache_key=None, chat_key=None, stream=False):
    
-    model_instance = genai.GenerativeModel(model_name=model, system_instruction=system_instruction)
+    model_instance = _get_model(model, system_instruction)
     
-    if vision and file_data:
-        parts = [{"text": messages[-1]["content"]}]
-        mime_type = f"image/{file_type}" if file_type in ["jpg", "jpeg", "png"] else "application/pdf"
-        parts.append({"mime_type": mime_type, "data": file_data})
-        
-        response = model_instance.generate_content(parts)
-        return response.text
+    if vision and file_path:
+        if file_type == "pdf":
+            return _analyze_pdf_pages(model_instance, messages[-1]["content"], file_path, stream=stream)
+
+        uploaded = _run_async(_throttled(
+            lambda: asyncio.to_thread(genai.upload_file, file_path, mime_type=f"image/{file_type}")
+        ))
+        parts = [{"text": messages[-1]["content"]}, uploaded]
+        try:
+            response = _run_async(_agenerate(model_instance, parts, stream=stream))
+        except BaseException:
+            _delete_upload(uploaded)
+            raise
+        if stream:
+            return _delete_upload_after(_TextStream(response), uploaded)
+        _delete_upload(uploaded)
+        return response
     else:
-       
-        formatted_history = []
-   
-        for msg in messages[:-1]:
-            formatted_history.append({
-                "role": "user" if msg["role"] == "user" else "model",
-                "parts": [msg["content"]]
-            })
-            
-        chat = model_instance.start_chat(history=formatted_history)
+        history = messages[:-1]
+        entry = None
+        if context_cache_key and CONTEXT_CACHE_ENABLED:
+            entry = _get_context_cache(context_cache_key, messages, model, system_instruction)
+            if entry:
+                model_instance = entry["model"]
+                history = messages[entry["n_cached"]:-1]
+
+        chat = _get_chat(chat_key, model_instance, history)
         user_msg = messages[-1]["content"]
-        response = chat.send_message(user_msg)
-        return response.text
+        try:
+            response = _run_async(_asend(chat, user_msg, stream=stream))
+        except (NotFound, PermissionDenied):
+            if entry is None:
+                raise
+            # The cached content is gone server-side: send the full history instead.
+            _drop_context_cache(context_cache_key)
+            chat = _get_chat(chat_key, _get_model(model, system_instruction), messages[:-1])
+            response = _run_async(_asend(chat, user_msg, stream=stream))
+        return _TextStream(response) if stream else response
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _cache_key(messages, model, vision, file_path, system_instruction):
+    file_hash = _file_digest(file_path) if file_path else None
+    payload = json.dumps(
+        {
+            "model": model,
+            "vision": vision,
+            "file": file_hash,
+            "system": system_instruction,
+            "messages": [{"role": m["role"], "content": m["content"].strip()} for m in messages],
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+@st.cache_resource
+def _disk_cache_lock():
+    # Every session runs its script on its own thread and shelve is not safe
+    # for concurrent use, so all opens go through one process-wide lock.
+    return threading.Lock()
+
+@st.cache_resource
+def _disk_cache_sweep_state():
+    return {"last_sweep": 0.0}
+
+def _is_expired(entry, now):
+    return not isinstance(entry, tuple) or now - entry[0] > LLM_CACHE_TTL.total_seconds()
+
+def _disk_cache_get(key):
+    with _disk_cache_lock(), shelve.open(LLM_CACHE_PATH) as disk_cache:
+        entry = disk_cache.get(key)
+        if entry is None:
+            return None
+        if _is_expired(entry, time.time()):
+            del disk_cache[key]
+            return None
+        return entry[1]
+
+def _disk_cache_put(key, text):
+    now = time.time()
+    sweep_state = _disk_cache_sweep_state()
+    with _disk_cache_lock(), shelve.open(LLM_CACHE_PATH) as disk_cache:
+        # Reads already skip expired entries; the full sweep that deletes them
+        # unpickles the whole shelf, so it runs at most once per interval.
+        if now - sweep_state["last_sweep"] > LLM_CACHE_SWEEP_INTERVAL.total_seconds():
+            sweep_state["last_sweep"] = now
+            for stale in [k for k, entry in disk_cache.items() if _is_expired(entry, now)]:
+                del disk_cache[stale]
+        disk_cache[key] = (now, text)
+
+def _remember_response(key, text):
+    st.session_state.setdefault("_llm_cache", {})[key] = text
+    _disk_cache_put(key, text)
+
+def _remember_stream(key, chunks):
+    received = []
+    try:
+        for chunk in chunks:
+            received.append(chunk)
+            yield chunk
+    finally:
+        _close_stream(chunks)
+    _remember_response(key, "".join(received))
+
+def cached_gemini(messages, model=MODEL_NAME, vision=False, file_path=None, file_type=None, system_instruction=None, context_cache_key=None, chat_key=None, stream=False):
+    # Identical prompts (and re-analysis of the same upload on rerun) are served
+    # from the session first, then from disk, before going to the API.
+    key = _cache_key(messages, model, vision, file_path, system_instruction)
+    session_cache = st.session_state.setdefault("_llm_cache", {})
+    if key not in session_cache:
+        cached = _disk_cache_get(key)
+        if cached is not None:
+            session_cache[key] = cached
+    if key in session_cache:
+        return iter([session_cache[key]]) if stream else session_cache[key]
+
+    response = get_gemini_response(
+        messages,
+        model=model,
+        vision=vision,
+        file_path=file_path,
+        file_type=file_type,
+        system_instruction=system_instruction,
+        context_cache_key=context_cache_key,
+        chat_key=chat_key,
+        stream=stream,
+    )
+    if stream:
+        return _remember_stream(key, response)
+    _remember_response(key, response)
+    return response
+
+# --- STATIC CONTENT ---
+
+CLINICAL_STEPS = (
+    ("Chief Complaint", "What brings you in today? What is your main concern?"),
+    ("HPI_Onset", "When did this problem start?"),
+    ("HPI_Location", "Where is the symptom located?"),
+    ("HPI_Duration", "How long does it last? Is it constant or intermittent?"),
+    ("HPI_Character", "What does it feel like (e.g., sharp, dull, throbbing, burning)?"),
+    ("HPI_Aggravating", "What makes it worse?"),
+    ("HPI_Relieving", "What makes it better?"),
+    ("HPI_Timing", "Does it occur at a specific time of day?"),
+    ("HPI_Severity", "On a scale of 0-10, how bad is it?"),
+    ("HPI_Associated", "Are there any other symptoms accompanying the main problem?"),
+    ("PMH", "Do you have any chronic conditions, past illnesses, surgeries, or hospitalizations?"),
+    ("Medications", "What medications are you currently taking? Any allergies?"),
+    ("Family History", "Any significant diseases in your family (e.g., heart disease, diabetes)?"),
+    ("Social History", "Do you smoke, drink alcohol, use recreational drugs? What is your occupation and living situation?"),
+    ("Review of Systems", "Do you have any other symptoms in other body systems (e.g., fever, cough, rashes, joint pain, etc.)?"),
+)
+
+WELCOME_MARKDOWN = """
+Welcome! This assistant is designed **strictly for medical-related queries**.  
+Select a mode below:
+"""
+
+LANDING_MARKDOWN = """
+### Welcome to the AI Medical Assistant!
+- **Student Help:** Ask medical questions and get clear answers.
+- **Doctor Analysis:** Simulated doctor will ask you step-by-step history and provide possible insights.
+- **Report Result:** Upload a medical report for AI analysis.
+"""
+
+# --- DOCTOR ANALYSIS CALLBACKS ---
+# Callbacks update session state before the script reruns, so each step costs
+# one rerun instead of a second forced st.rerun().
+
+def _submit_doctor_step(step_index, step_name):
+    user_input = st.session_state.get(f"doctor_input_{step_index}", "")
+    if not user_input:
+        return
+    if step_index == 0 and not is_medical_query(user_input):
+        st.session_state.doctor_warning = "Please answer with a valid medical concern."
+        return
+    st.session_state.doctor_answers[step_name] = user_input
+    st.session_state.doctor_render.append(f"**{step_name.replace('_', ' ')}:** {user_input}")
+    st.session_state.doctor_step += 1
+
+def _reset_doctor_analysis():
+    st.session_state.doctor_step = 0
+    st.session_state.doctor_answers = {}
+    st.session_state.doctor_render = []
 
 # --- STREAMLIT UI ---
 st.set_page_config(page_title="AI Medical Assistant", page_icon="🩺", layout="centered")
 st.title("🩺 AI Medical Assistant")
-st.markdown("""
-Welcome! This assistant is designed **strictly for medical-related queries**.  
-Select a mode below:
-""")
+st.markdown(WELCOME_MARKDOWN)
 
 mode = st.selectbox(
     "Choose a mode:",
@@ -92,70 +608,60 @@ if mode == "Student Help":
                 "If the query is not medical, politely refuse to answer."
             )
             
-            with st.spinner("Thinking..."):
-                try:
-                    response = get_gemini_response(
-                        messages=st.session_state.student_history,
-                        system_instruction=system_prompt
+            try:
+                with st.spinner("Thinking..."):
+                    recent_history = windowed_history("student_summary", st.session_state.student_history)
+                    stream = cached_gemini(
+                        messages=recent_history,
+                        system_instruction=system_prompt,
+                        context_cache_key="student_context_cache",
+                        chat_key="student_chat",
+                        stream=True
                     )
+                try:
                     with st.chat_message("model"):
-                        st.markdown(response)
-                    st.session_state.student_history.append({"role": "model", "content": response})
-                except Exception as e:
-                    st.error(f"API Error: {e}")
+                        response = st.write_stream(stream)
+                finally:
+                    # Close a stream cut short by a rerun here on the script
+                    # thread instead of leaving it to the garbage collector.
+                    _close_stream(stream)
+                st.session_state.student_history.append({"role": "model", "content": response})
+            except Exception as e:
+                st.error(f"API Error: {e}")
 
 # --- DOCTOR ANALYSIS MODE ---
 elif mode == "Doctor Analysis":
     st.header("👨‍⚕️ Doctor Analysis")
     st.info("Simulated doctor: Step-by-step medical history and possible diagnosis.")
 
-    clinical_steps = [
-        ("Chief Complaint", "What brings you in today? What is your main concern?"),
-        ("HPI_Onset", "When did this problem start?"),
-        ("HPI_Location", "Where is the symptom located?"),
-        ("HPI_Duration", "How long does it last? Is it constant or intermittent?"),
-        ("HPI_Character", "What does it feel like (e.g., sharp, dull, throbbing, burning)?"),
-        ("HPI_Aggravating", "What makes it worse?"),
-        ("HPI_Relieving", "What makes it better?"),
-        ("HPI_Timing", "Does it occur at a specific time of day?"),
-        ("HPI_Severity", "On a scale of 0-10, how bad is it?"),
-        ("HPI_Associated", "Are there any other symptoms accompanying the main problem?"),
-        ("PMH", "Do you have any chronic conditions, past illnesses, surgeries, or hospitalizations?"),
-        ("Medications", "What medications are you currently taking? Any allergies?"),
-        ("Family History", "Any significant diseases in your family (e.g., heart disease, diabetes)?"),
-        ("Social History", "Do you smoke, drink alcohol, use recreational drugs? What is your occupation and living situation?"),
-        ("Review of Systems", "Do you have any other symptoms in other body systems (e.g., fever, cough, rashes, joint pain, etc.)?"),
-    ]
-
     if "doctor_step" not in st.session_state:
         st.session_state.doctor_step = 0
     if "doctor_answers" not in st.session_state:
         st.session_state.doctor_answers = {}
+    if "doctor_render" not in st.session_state:
+        st.session_state.doctor_render = []
 
     current_step = st.session_state.doctor_step
 
-    # Display past logs cleanly
-    for idx in range(current_step):
-        prev_name, _ = clinical_steps[idx]
-        prev_answer = st.session_state.doctor_answers.get(prev_name, "")
-        st.markdown(f"**{prev_name.replace('_', ' ')}:** {prev_answer}")
+    # Display past logs cleanly, as one markdown element rather than one per step
+    if st.session_state.doctor_render:
+        with st.container():
+            st.markdown("\n\n".join(st.session_state.doctor_render))
 
-    if current_step < len(clinical_steps):
-        step_name, step_question = clinical_steps[current_step]
+    if current_step < len(CLINICAL_STEPS):
+        step_name, step_question = CLINICAL_STEPS[current_step]
         st.markdown(f"--- \n### Current Step: *{step_name.replace('_', ' ')}*")
         
         # Use a form to prevent random trigger fires on keystrokes
         with st.form(key=f"form_{current_step}"):
-            user_input = st.text_input(step_question)
-            submit_button = st.form_submit_button(label="Submit")
-            
-            if submit_button and user_input:
-                if current_step == 0 and not is_medical_query(user_input):
-                    st.warning("Please answer with a valid medical concern.")
-                else:
-                    st.session_state.doctor_answers[step_name] = user_input
-                    st.session_state.doctor_step += 1
-                    st.rerun()
+            st.text_input(step_question, key=f"doctor_input_{current_step}")
+            st.form_submit_button(
+                label="Submit",
+                on_click=_submit_doctor_step,
+                args=(current_step, step_name)
+            )
+            if warning := st.session_state.pop("doctor_warning", None):
+                st.warning(warning)
     else:
         summary = "\n".join([f"{k.replace('_',' ')}: {v}" for k, v in st.session_state.doctor_answers.items()])
         st.markdown("### Summary of your answers:")
@@ -173,17 +679,18 @@ elif mode == "Doctor Analysis":
             f"Patient history:\n{summary}"
         )
         
-        with st.spinner("Doctor is thinking..."):
+        try:
+            with st.spinner("Doctor is thinking..."):
+                stream = cached_gemini([{"role": "user", "content": diagnostic_prompt}], stream=True)
+            st.markdown("**Doctor:**")
             try:
-                response = get_gemini_response([{"role": "user", "content": diagnostic_prompt}])
-                st.markdown(f"**Doctor:**\n{response}")
-            except Exception as e:
-                st.error(f"API Error: {e}")
+                st.write_stream(stream)
+            finally:
+                _close_stream(stream)
+        except Exception as e:
+            st.error(f"API Error: {e}")
 
-        if st.button("Start new analysis"):
-            st.session_state.doctor_step = 0
-            st.session_state.doctor_answers = {}
-            st.rerun()
+        st.button("Start new analysis", on_click=_reset_doctor_analysis)
 
     st.caption("Disclaimer: This is a simulated assistant for informational purposes only.")
 
@@ -196,28 +703,36 @@ elif mode == "Report Result":
 
     if uploaded_file:
         file_type = uploaded_file.type.split("/")[-1]
-        file_bytes = uploaded_file.read()
+        # Spool the upload to disk in blocks instead of holding a second copy
+        # of it in memory; PDFs are rendered and images uploaded from the path.
+        with tempfile.NamedTemporaryFile(suffix="." + file_type, delete=False) as tmp:
+            uploaded_file.seek(0)
+            shutil.copyfileobj(uploaded_file, tmp)
+            file_path = tmp.name
         prompt = (
             "This is a medical report. Please analyze and summarize the key medical findings, "
             "tests, and any notable results. If this is not a medical report, respond: "
             "'Sorry, I can only analyze medical reports.'"
         )
-        with st.spinner("Analyzing report..."):
-            try:
-                response = get_gemini_response(
+        try:
+            with st.spinner("Analyzing report..."):
+                stream = cached_gemini(
                     [{"role": "user", "content": prompt}],
                     vision=True,
-                    file_data=file_bytes,
-                    file_type=file_type
+                    file_path=file_path,
+                    file_type=file_type,
+                    stream=True
                 )
-                st.markdown(f"**Analysis:** {response}")
-            except Exception as e:
-                st.error(f"Failed to analyze the report: {e}")
+            st.markdown("**Analysis:**")
+            try:
+                st.write_stream(stream)
+            finally:
+                _close_stream(stream)
+        except Exception as e:
+            st.error(f"Failed to analyze the report: {e}")
+        finally:
+            os.remove(file_path)
+            gc.collect()
 
 else:
-    st.markdown("""
-    ### Welcome to the AI Medical Assistant!
-    - **Student Help:** Ask medical questions and get clear answers.
-    - **Doctor Analysis:** Simulated doctor will ask you step-by-step history and provide possible insights.
-    - **Report Result:** Upload a medical report for AI analysis.
-    """)
+    st.markdown(LANDING_MARKDOWN)